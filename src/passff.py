@@ -10,6 +10,11 @@ import struct
 import subprocess
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 VERSION = "_VERSIONHOLDER_"
 
 ###############################################################################
@@ -27,6 +32,11 @@ CHARSET = "UTF-8"
 ######################### End preferences section #############################
 ###############################################################################
 
+# Process environment with the preference overrides applied, computed once
+# at import time; requests pass it to the subprocess as-is.
+_BASE_ENV = {**os.environ, **COMMAND_ENV}
+_BASE_ENV.setdefault("HOME", os.path.expanduser('~'))
+
 
 def getMessage():
     """ Read a message from stdin and decode it. """
@@ -40,77 +50,101 @@ def getMessage():
 
 def encodeMessage(messageContent):
     """ Encode a message for transmission, given its content. """
-    encodedContent = json.dumps(messageContent)
-    encodedLength = struct.pack('@I', len(encodedContent))
-    return {'length': encodedLength, 'content': encodedContent}
+    if orjson is not None:
+        encodedContent = orjson.dumps(messageContent)
+    else:
+        encodedContent = json.dumps(
+            messageContent, separators=(',', ':'), ensure_ascii=False
+        ).encode(CHARSET)
+    return struct.pack('@I', len(encodedContent)) + encodedContent
 
 
 def sendMessage(encodedMessage):
     """ Send an encoded message to stdout. """
-    sys.stdout.buffer.write(encodedMessage['length'])
-    sys.stdout.write(encodedMessage['content'])
-    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    view = memoryview(encodedMessage)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def handleShow(receivedMessage):
+    """ Default handler: show an entry (or the whole tree). """
+    if len(receivedMessage) == 0:
+        return ["show"], ["/"], None
+    key = receivedMessage[0]
+    key = "/" + (key[1:] if key[0] == "/" else key)
+    return ["show"], [key], None
+
+
+def handleInsert(receivedMessage):
+    """ Insert a new multiline entry from the message body. """
+    return ["insert", "-m"], [receivedMessage[1]], receivedMessage[2]
+
+
+def handleGenerate(receivedMessage):
+    """ Generate a new password entry. """
+    opt_args = ["generate"]
+    if "-n" in receivedMessage[3:]:
+        opt_args.append("-n")
+    return opt_args, [receivedMessage[1], receivedMessage[2]], None
+
+
+def handleGrepMetaUrls(receivedMessage):
+    """ Grep the store for entries with the given url fields. """
+    if len(receivedMessage) != 2:
+        return handleShow(receivedMessage)
+    url_field_names = receivedMessage[1]
+    return ["grep", "-iE"], ["^({}):".format('|'.join(url_field_names))], None
+
+
+def handleOtp(receivedMessage):
+    """ Generate a one-time password for an entry. """
+    if len(receivedMessage) != 2:
+        return handleShow(receivedMessage)
+    key = receivedMessage[1]
+    key = "/" + (key[1:] if key[0] == "/" else key)
+    return ["otp"], [key], None
+
+
+HANDLERS = {
+    "insert": handleInsert,
+    "generate": handleGenerate,
+    "grepMetaUrls": handleGrepMetaUrls,
+    "otp": handleOtp,
+}
 
 
 if __name__ == "__main__":
     # Read message from standard input
     receivedMessage = getMessage()
-    opt_args = []
-    pos_args = []
-    std_input = None
 
     if len(receivedMessage) == 0:
-        opt_args = ["show"]
-        pos_args = ["/"]
-    elif receivedMessage[0] == "insert":
-        opt_args = ["insert", "-m"]
-        pos_args = [receivedMessage[1]]
-        std_input = receivedMessage[2]
-    elif receivedMessage[0] == "generate":
-        opt_args = ["generate"]
-        pos_args = [receivedMessage[1], receivedMessage[2]]
-        if "-n" in receivedMessage[3:]:
-            opt_args.append("-n")
-    elif receivedMessage[0] == "grepMetaUrls" and len(receivedMessage) == 2:
-        opt_args = ["grep", "-iE"]
-        url_field_names = receivedMessage[1]
-        pos_args = ["^({}):".format('|'.join(url_field_names))]
-    elif receivedMessage[0] == "otp" and len(receivedMessage) == 2:
-        opt_args = ["otp"]
-        key = receivedMessage[1]
-        key = "/" + (key[1:] if key[0] == "/" else key)
-        pos_args = [key]
+        handler = handleShow
     else:
-        opt_args = ["show"]
-        key = receivedMessage[0]
-        key = "/" + (key[1:] if key[0] == "/" else key)
-        pos_args = [key]
+        handler = HANDLERS.get(receivedMessage[0], handleShow)
+    opt_args, pos_args, std_input = handler(receivedMessage)
     opt_args += COMMAND_ARGS
 
-    # Set up (modified) command environment
-    env = dict(os.environ)
-    if "HOME" not in env:
-        env["HOME"] = os.path.expanduser('~')
-    for key, val in COMMAND_ENV.items():
-        env[key] = val
-
     # Set up subprocess params
     cmd = [COMMAND] + opt_args + ['--'] + pos_args
     proc_params = {
-        'input': bytes(std_input, CHARSET) if std_input else None,
+        'stdin': subprocess.PIPE if std_input else None,
         'stdout': subprocess.PIPE,
         'stderr': subprocess.PIPE,
-        'env': env
+        'bufsize': 65536,
+        'env': _BASE_ENV
     }
 
     # Run and communicate with pass script
-    proc = subprocess.run(cmd, **proc_params)
+    proc = subprocess.Popen(cmd, **proc_params)
+    proc_stdout, proc_stderr = proc.communicate(
+        input=bytes(std_input, CHARSET) if std_input else None)
 
     # Send response
     sendMessage(
         encodeMessage({
             "exitCode": proc.returncode,
-            "stdout": proc.stdout.decode(CHARSET),
-            "stderr": proc.stderr.decode(CHARSET),
+            "stdout": proc_stdout.decode(CHARSET),
+            "stderr": proc_stderr.decode(CHARSET),
             "version": VERSION
         }))